@@ -1,8 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.utils import get_column_letter
+import difflib
 import os
+from concurrent.futures import ThreadPoolExecutor
+import re
+from io import BytesIO
 from pathlib import Path
 import tempfile
 
@@ -80,6 +91,67 @@ BUILT_IN_MAPPINGS = {
     }
 }
 
+# Lookup tables over BUILT_IN_MAPPINGS, built once at import instead of per
+# comparator instance (Streamlit constructs a fresh one on every rerun)
+_MAPPINGS_LIST = list(BUILT_IN_MAPPINGS.keys())
+_UPPER_PATTERNS = {p.upper(): p for p in BUILT_IN_MAPPINGS}
+# One regex alternation over all patterns beats N substring scans. Python's
+# re picks the first alternative that matches, not the longest, so order the
+# patterns longest-first to keep a short generic pattern from shadowing a
+# more specific one that contains it.
+_PATTERN_REGEX = re.compile('|'.join(
+    re.escape(p) for p in sorted(_UPPER_PATTERNS, key=len, reverse=True)
+))
+
+def _read_excel_fast(file, sheet_name=None, skiprows=0):
+    """Read one sheet of an xlsx file into a DataFrame using openpyxl's
+    streaming reader (much faster than building the full workbook DOM)"""
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        # Default to the first sheet like pd.read_excel's sheet_name=0;
+        # workbook.active is whichever tab was selected on last save
+        worksheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        return _sheet_to_df(worksheet, skiprows)
+    finally:
+        workbook.close()
+
+def _sheet_to_df(worksheet, skiprows=0):
+    """Stream one worksheet into a DataFrame; reuse the open workbook
+    handle when reading several sheets so the zip is only parsed once"""
+    rows = worksheet.iter_rows(values_only=True)
+    for _ in range(skiprows):
+        next(rows, None)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    data = list(rows)
+    if not data:
+        return pd.DataFrame(columns=header)
+    if len(set(header)) != len(header):
+        # Duplicate header names can't key a dict; let pandas disambiguate
+        return pd.DataFrame(data, columns=header)
+
+    # Build numeric columns as float64 arrays up front so the comparison
+    # kernel gets real float blocks instead of object columns that pandas
+    # would have to re-scan and cast later
+    columns = {}
+    for name, values in zip(header, zip(*data)):
+        try:
+            columns[name] = np.asarray(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            columns[name] = np.asarray(values, dtype=object)
+    return pd.DataFrame(columns)
+
+@st.cache_data(show_spinner=False)
+def _load_unify(file_bytes):
+    """Parse a UNIFY workbook, cached on the file bytes across reruns"""
+    return _read_excel_fast(BytesIO(file_bytes), skiprows=7)
+
+@st.cache_data(show_spinner=False)
+def _load_extract(file_bytes):
+    """Parse an EXTRACT workbook, cached on the file bytes across reruns"""
+    return _read_excel_fast(BytesIO(file_bytes), sheet_name='Sheet2')
+
 class StreamlitExcelComparator:
     def __init__(self, threshold=0.01):
         self.threshold = threshold
@@ -93,14 +165,8 @@ class StreamlitExcelComparator:
     def match_filename_to_mapping(self, filename):
         """Match filename to appropriate mapping configuration (case-insensitive)"""
         filename_base = Path(filename).stem.upper()
-        
-        # Try case-insensitive match against all patterns
-        for original_pattern in self.mappings.keys():
-            pattern_upper = original_pattern.upper()
-            if pattern_upper in filename_base:
-                return original_pattern
-        
-        return None
+        match = _PATTERN_REGEX.search(filename_base)
+        return _UPPER_PATTERNS[match.group(0)] if match else None
 
     def validate_file_mappings(self, file1_name, file2_name):
         """Validate that both files match the same mapping pattern"""
@@ -117,7 +183,7 @@ class StreamlitExcelComparator:
             
             error_msg = f"❌ No mapping found for: {', '.join(missing_files)}\n"
             error_msg += "Available mapping patterns:\n"
-            for i, pattern in enumerate(self.mappings.keys(), 1):
+            for i, pattern in enumerate(_MAPPINGS_LIST, 1):
                 error_msg += f"  {i}. {pattern}\n"
             
             return None, None, error_msg
@@ -137,7 +203,10 @@ class StreamlitExcelComparator:
         if 'ProdHier' not in df.columns:
             return df
 
-        filtered_df = df[df['ProdHier'] == prod_hier_filter].copy()
+        # NumPy-level equality, and masking already allocates a fresh frame
+        # so the extra .copy() would just double memory on the largest file
+        mask = df['ProdHier'].to_numpy() == prod_hier_filter
+        filtered_df = df.loc[mask]
 
         if filtered_df.empty:
             st.warning("Warning: select the correct UNIFY and EXTRACT files.")
@@ -150,32 +219,19 @@ class StreamlitExcelComparator:
             return df
 
         try:
-            if df[col_name].dtype == 'object' and 'Week ending' in str(df[col_name].iloc[0]):
-                df['Date'] = pd.to_datetime(
-                    df[col_name].str.extract(r'(\d{2}-\d{2}-\d{4})')[0],
-                    dayfirst=True
-                )
+            ser = df[col_name]
+            if ser.dtype == 'object' and ser.str.startswith('Week ending', na=False).any():
+                # 'Week ending dd-mm-yyyy': the date is the fixed-width tail,
+                # so slice it out and parse with an explicit format instead of
+                # running a regex extract plus format inference per cell
+                df['Date'] = pd.to_datetime(ser.str[-10:], format='%d-%m-%Y', errors='coerce')
             else:
-                df['Date'] = pd.to_datetime(df[col_name])
+                df['Date'] = pd.to_datetime(ser, dayfirst=True, errors='coerce', cache=True)
             return df
         except Exception as e:
             st.error(f"Error parsing dates from column '{col_name}': {e}")
             return df
 
-    def compare_values(self, val1, val2):
-        """Compare two values and return difference if above threshold"""
-        if pd.isna(val1) and pd.isna(val2):
-            return None, 0
-        if pd.isna(val1) or pd.isna(val2):
-            return True, abs(float(val1 or 0) - float(val2 or 0))
-
-        try:
-            v1, v2 = float(val1), float(val2)
-            diff = abs(v1 - v2)
-            return diff > self.threshold, diff
-        except (ValueError, TypeError):
-            return val1 != val2, 0
-
     def get_column_mapping(self, mapping_pattern, df1_cols, df2_cols):
         """Create column mapping between two dataframes based on pattern (case-insensitive)"""
         if mapping_pattern not in self.mappings:
@@ -184,27 +240,55 @@ class StreamlitExcelComparator:
         target_columns = self.mappings[mapping_pattern]['geographies']
         column_map = {}
 
+        # Lowercase each side once instead of re-lowercasing per pair
+        low1 = {str(col).lower(): col for col in df1_cols}
+        low2 = {str(col).lower(): col for col in df2_cols}
+        target_lowers = [t.lower() for t in target_columns]
+
+        def find_match(target_col, target_lower, lowered_cols, taken):
+            # Exact match first, then a single substring pass
+            match = lowered_cols.get(target_lower)
+            if match is not None:
+                return match
+            match = next(
+                (col for key, col in lowered_cols.items()
+                 if target_lower in key or key in target_lower),
+                None
+            )
+            if match is not None:
+                return match
+            # Fuzzy fallback for lightly renamed columns. The geography names
+            # are mutually similar, so a loose match can silently pair two
+            # different geographies: only consider columns that are not
+            # already claimed and don't exact/substring-match a different
+            # target, demand a near-identical ratio, and warn when it fires
+            candidates = [
+                key for key, col in lowered_cols.items()
+                if col not in taken and not any(
+                    other != target_lower and (other in key or key in other)
+                    for other in target_lowers
+                )
+            ]
+            close = difflib.get_close_matches(target_lower, candidates, n=1, cutoff=0.9)
+            if close:
+                match = lowered_cols[close[0]]
+                st.warning(f"⚠️  Fuzzy-matched target column '{target_col}' to '{match}'")
+                return match
+            return None
+
         for target_col in target_columns:
-            col1_match = None
-            col2_match = None
-
-            # Find matching columns (case-insensitive)
-            for col in df1_cols:
-                if (target_col.lower() == str(col).lower() or
-                    target_col.lower() in str(col).lower() or
-                    str(col).lower() in target_col.lower()):
-                    col1_match = col
-                    break
-
-            for col in df2_cols:
-                if (target_col.lower() == str(col).lower() or
-                    target_col.lower() in str(col).lower() or
-                    str(col).lower() in target_col.lower()):
-                    col2_match = col
-                    break
+            target_lower = target_col.lower()
+            col1_match = find_match(target_col, target_lower, low1, set(column_map))
+            col2_match = find_match(target_col, target_lower, low2, set(column_map.values()))
 
             if col1_match and col2_match:
-                column_map[col1_match] = col2_match
+                if col1_match in column_map:
+                    st.warning(
+                        f"⚠️  Column '{col1_match}' is already mapped; "
+                        f"skipping target column: '{target_col}'"
+                    )
+                else:
+                    column_map[col1_match] = col2_match
             else:
                 st.warning(f"⚠️  No match found for target column: '{target_col}'")
 
@@ -219,7 +303,7 @@ class StreamlitExcelComparator:
                 return col
         return None
 
-    def generate_report(self, mismatch_rows, common_dates, mapping_pattern,
+    def generate_report(self, differences_df, common_dates, mapping_pattern,
                         total_comparisons, significant_differences, file1_name, file2_name,
                         prod_hier_filter, new_dates):
         """Generate Excel report with results"""
@@ -228,9 +312,8 @@ class StreamlitExcelComparator:
 
         # Create a temporary file for the report
         current_date = pd.Timestamp.now().strftime('%d-%m-%Y')
-        
+
         # Create a BytesIO buffer for the Excel file
-        from io import BytesIO
         buffer = BytesIO()
 
         with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
@@ -252,36 +335,36 @@ class StreamlitExcelComparator:
             summary_df.to_excel(writer, index=False, sheet_name="Summary")
 
             # Significant differences sheet
-            if mismatch_rows:
-                differences_df = pd.DataFrame(mismatch_rows)
+            if not differences_df.empty:
                 differences_df.to_excel(writer, index=False, sheet_name="Significant_Differences")
-                self.highlight_differences_in_writer(writer, "Significant_Differences")
+                self.highlight_differences_in_writer(writer, "Significant_Differences",
+                                                     len(differences_df), len(differences_df.columns))
             else:
                 pd.DataFrame([{"Message": "No mismatches found."}]).to_excel(writer, index=False, sheet_name="Mismatches")
 
             # New dates sheet
             if len(new_dates) > 0:
                 new_dates_df = pd.DataFrame({
-                    'New_Dates': [date.strftime('%Y-%m-%d') for date in new_dates]
+                    'New_Dates': new_dates.strftime('%Y-%m-%d')
                 })
                 new_dates_df.to_excel(writer, index=False, sheet_name="New_Dates")
 
         buffer.seek(0)
         return buffer, f"qc_report_{mapping_pattern}_{current_date}.xlsx"
 
-    def highlight_differences_in_writer(self, writer, sheet_name):
+    def highlight_differences_in_writer(self, writer, sheet_name, n_rows, n_cols):
         """Highlight significant differences in the Excel writer"""
         try:
-            workbook = writer.book
             worksheet = writer.sheets[sheet_name]
             fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
 
-            # Highlight rows with differences above threshold
-            for row in range(2, worksheet.max_row + 1):  # Skip header
-                diff_cell = worksheet.cell(row=row, column=6)  # Difference column
-                if diff_cell.value and float(diff_cell.value) > self.threshold:
-                    for col in range(1, worksheet.max_column + 1):
-                        worksheet.cell(row=row, column=col).fill = fill
+            # A single conditional-format rule makes Excel do the per-row
+            # threshold check at render time; no Python loop over the cells
+            cell_range = f"A2:{get_column_letter(n_cols)}{n_rows + 1}"
+            worksheet.conditional_formatting.add(
+                cell_range,
+                FormulaRule(formula=[f"$F2>{self.threshold}"], fill=fill)
+            )
         except Exception as e:
             st.error(f"Error applying highlighting: {e}")
 
@@ -297,9 +380,15 @@ class StreamlitExcelComparator:
             mapping_pattern = pattern1
             prod_hier_filter = self.mappings[mapping_pattern]['prod_hier_filter']
 
-            # Load dataframes
-            df1 = pd.read_excel(unify_file, skiprows=7)            # Unify
-            df2 = pd.read_excel(extract_file, sheet_name='Sheet2')    # Extract
+            # Load dataframes (cached on file bytes, so Streamlit reruns
+            # with the same uploads skip the xlsx parse entirely). The two
+            # parses are independent and zlib decompression releases the
+            # GIL, so run them in parallel on a cache miss.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                unify_future = executor.submit(_load_unify, unify_file.getvalue())
+                extract_future = executor.submit(_load_extract, extract_file.getvalue())
+                df1 = unify_future.result()      # Unify
+                df2 = extract_future.result()    # Extract
 
             # Filter Extract file by ProdHier
             df2_filtered = self.filter_extract_by_prodhier(df2, prod_hier_filter)
@@ -320,6 +409,19 @@ class StreamlitExcelComparator:
             if 'Date' not in df1.columns or 'Date' not in df2_filtered.columns:
                 return None, "Could not parse dates from files"
 
+            # Resolve the column mapping before indexing so the projection
+            # below uses exactly the matcher's choices instead of a second
+            # copy of its heuristic that could disagree with it
+            column_map = self.get_column_mapping(mapping_pattern, df1.columns, df2_filtered.columns)
+
+            if not column_map:
+                return None, "No column mappings found. Please check your mapping configuration."
+
+            # Keep only the mapped UNIFY columns (plus the parsed Date) so
+            # set_index and the .loc alignment below don't rebuild blocks
+            # for columns that are never compared
+            df1 = df1[list(column_map.keys()) + ['Date']]
+
             # Set date as index
             df1.set_index('Date', inplace=True)
             df2_filtered.set_index('Date', inplace=True)
@@ -334,49 +436,72 @@ class StreamlitExcelComparator:
             df1_aligned = df1.loc[common_dates]
             df2_aligned = df2_filtered.loc[common_dates]
 
-            # Get column mapping
-            column_map = self.get_column_mapping(mapping_pattern, df1_aligned.columns, df2_aligned.columns)
-
-            if not column_map:
-                return None, "No column mappings found. Please check your mapping configuration."
-
-            # Compare mapped columns
-            mismatch_rows = []
-            total_comparisons = 0
-            significant_differences = 0
-
-            for col1, col2 in column_map.items():
-                for date in common_dates:
-                    val1 = df1_aligned.at[date, col1]
-                    val2 = df2_aligned.at[date, col2]
-                    total_comparisons += 1
-
-                    is_different, difference = self.compare_values(val1, val2)
-
-                    if is_different and difference > self.threshold:
-                        significant_differences += 1
-                        mismatch_rows.append({
-                            "Date": date.strftime('%Y-%m-%d'),
-                            "Column File 1": col1,
-                            "Value File 1": val1,
-                            "Column File 2": col2,
-                            "Value File 2": val2,
-                            "Difference": difference,
-                            "Above_Threshold": True
-                        })
+            # Project down to the mapped columns before comparing so the
+            # float blocks only carry data that is actually compared
+            col1_names = list(column_map.keys())
+            col2_names = list(column_map.values())
+            df1_aligned = df1_aligned[col1_names]
+            df2_aligned = df2_aligned[col2_names]
+
+            # Compare mapped columns as whole float blocks instead of cell by
+            # cell, coercing rather than casting so a stray text cell
+            # ('n.a.', '-') in an export becomes NaN instead of aborting
+            A = df1_aligned.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+            B = df2_aligned.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+            # Both NaN means "no data on either side" -> not a difference;
+            # a single NaN is compared against 0
+            if ne is not None:
+                # numexpr fuses the whole expression into one chunked pass,
+                # avoiding the intermediate arrays the np.where chain allocates
+                diff = ne.evaluate(
+                    "where(isnan(A) & isnan(B), 0.0,"
+                    " abs(where(isnan(A), 0.0, A) - where(isnan(B), 0.0, B)))"
+                )
+            else:
+                both_nan = np.isnan(A) & np.isnan(B)
+                diff = np.where(both_nan, 0.0, np.abs(np.nan_to_num(A) - np.nan_to_num(B)))
+            mask = diff > self.threshold
+
+            total_comparisons = A.size
+            significant_differences = int(mask.sum())
+
+            # Build the differences frame from whole column arrays; a dict of
+            # arrays skips the per-row dict allocation and dtype inference
+            # that pd.DataFrame(list_of_dicts) would do
+            rows, cols = np.nonzero(mask)
+            date_strings = common_dates.strftime('%Y-%m-%d').to_numpy()
+            col1_arr = np.asarray(col1_names, dtype=object)
+            col2_arr = np.asarray(col2_names, dtype=object)
+
+            differences_df = pd.DataFrame({
+                "Date": date_strings[rows],
+                "Column File 1": col1_arr[cols],
+                "Value File 1": A[rows, cols],
+                "Column File 2": col2_arr[cols],
+                "Value File 2": B[rows, cols],
+                "Difference": diff[rows, cols],
+                "Above_Threshold": True
+            })
 
             # Update summary stats
             self.summary_stats['compared_sheets'] = 1
             self.summary_stats['total_mismatches'] = significant_differences
             self.summary_stats['total_new_dates'] = len(new_dates)
 
-            # Generate report
-            report_buffer, report_filename = self.generate_report(
-                mismatch_rows, common_dates, mapping_pattern,
-                total_comparisons, significant_differences, 
-                unify_file.name, extract_file.name,
-                prod_hier_filter, new_dates
-            )
+            # Package everything the report needs; the xlsx itself is only
+            # serialized when the user asks for it in main()
+            report_args = {
+                'differences_df': differences_df,
+                'common_dates': common_dates,
+                'mapping_pattern': mapping_pattern,
+                'total_comparisons': total_comparisons,
+                'significant_differences': significant_differences,
+                'file1_name': unify_file.name,
+                'file2_name': extract_file.name,
+                'prod_hier_filter': prod_hier_filter,
+                'new_dates': new_dates
+            }
 
             # Create summary for display
             first_date = common_dates.min().strftime('%Y-%m-%d')
@@ -394,8 +519,7 @@ class StreamlitExcelComparator:
 
             return {
                 'summary': summary,
-                'report_buffer': report_buffer,
-                'report_filename': report_filename
+                'report_args': report_args
             }, None
 
         except Exception as e:
@@ -412,6 +536,8 @@ def main():
         st.session_state.comparison_result = None
     if 'error_message' not in st.session_state:
         st.session_state.error_message = None
+    if 'report_file' not in st.session_state:
+        st.session_state.report_file = None
     
     # File upload section
     st.header("📁 Upload files")
@@ -447,6 +573,7 @@ def main():
                 comparator = StreamlitExcelComparator()
                 result, error = comparator.compare_files(unify_file, extract_file)
                 
+                st.session_state.report_file = None
                 if error:
                     st.session_state.error_message = error
                     st.session_state.comparison_result = None
@@ -478,17 +605,26 @@ def main():
             st.metric("Total New Dates", summary['total_new_dates'])
             st.metric("Success Rate", f"{summary['success_rate']}%")
                 
-        # Download button
+        # Download section: the xlsx is only serialized once the user asks
+        # for it, so eyeballing the summary stays free of openpyxl work
         st.header("📄 Download Report")
-        
-        st.download_button(
-            label="Download Excel Report",
-            data=st.session_state.comparison_result['report_buffer'],
-            file_name=st.session_state.comparison_result['report_filename'],
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        
-        st.success("Report generated successfully! Click the button above to download.")
+
+        if st.button("Generate Excel report"):
+            with st.spinner("Building report..."):
+                comparator = StreamlitExcelComparator()
+                st.session_state.report_file = comparator.generate_report(
+                    **st.session_state.comparison_result['report_args']
+                )
+
+        if st.session_state.report_file:
+            report_buffer, report_filename = st.session_state.report_file
+            st.download_button(
+                label="Download Excel Report",
+                data=report_buffer,
+                file_name=report_filename,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+            st.success("Report generated successfully! Click the button above to download.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file